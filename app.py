@@ -1,11 +1,23 @@
 import streamlit as st
 import requests
-import base64
-import json
-import pandas as pd
-import altair as alt
+import hashlib
+import queue
+import re
+import sqlite3
+import threading
+import time
+import orjson
 from PIL import Image
 from io import BytesIO
+from concurrent.futures import Future
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
 
 st.set_page_config(
     page_title="NutriSnap AI",
@@ -20,9 +32,61 @@ except FileNotFoundError:
     st.error("Secrets file not found. Please set up your .streamlit/secrets.toml")
     st.stop()
 
+MAX_IMAGE_EDGE = 1024
+ANALYSIS_DB_PATH = ".nutrisnap_cache.sqlite3"
+MAX_IN_FLIGHT = 5
+BATCH_MAX_SIZE = 4
+BATCH_MAX_WAIT = 0.2
+RISK_LEVELS = ("Low", "Medium", "High")
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
 MODEL_URL = (
     "https://generativelanguage.googleapis.com/v1beta/models/"
-    "gemini-2.5-flash-preview-09-2025:generateContent"
+    "gemini-2.5-flash-preview-09-2025"
+)
+
+ANALYSIS_SCHEMA = """{
+  "foodName": "string",
+  "cuisineType": "string",
+  "calories": number,
+  "macronutrients": { "proteinG": number, "carbsG": number, "fatG": number },
+  "insightSummary": "string (short, engaging 1-sentence summary)",
+  "dietaryTags": ["string (e.g. Vegan, Keto, Gluten-Free, High-Protein)"],
+  "recipe": {
+    "title": "string",
+    "ingredients": ["string (with quantities)"],
+    "instructions": ["string"]
+  },
+  "allergenAlert": {
+    "riskLevel": "Low | Medium | High",
+    "detected": ["string"],
+    "advice": "string"
+  }
+}"""
+
+SYSTEM_PROMPT = f"""
+You are NutriSnap AI, an expert food analyst.
+Analyze the image of the meal and return a JSON object STRICTLY following this schema:
+{ANALYSIS_SCHEMA}
+"""
+
+BATCH_SYSTEM_PROMPT = f"""
+You are NutriSnap AI, an expert food analyst.
+You will receive several meal photos, each preceded by a label of the form "Image N".
+Return a JSON array STRICTLY containing exactly one object per photo. Each object must contain
+"imageIndex": number (the N of the photo it describes) plus every field of this schema:
+{ANALYSIS_SCHEMA}
+"""
+
+SYSTEM_INSTRUCTION = {"parts": [{"text": SYSTEM_PROMPT}]}
+BATCH_SYSTEM_INSTRUCTION = {"parts": [{"text": BATCH_SYSTEM_PROMPT}]}
+GENERATION_CONFIG = {"responseMimeType": "application/json"}
+ANALYZE_PROMPT_PART = {"text": "Analyze this food photo and return structured nutrition data."}
+
+# Top-level fields worth showing before the full response has arrived, matched once their value is complete.
+PARTIAL_FIELD_RE = re.compile(
+    r'"(foodName|cuisineType|calories|macronutrients)"\s*:\s*'
+    r'("(?:[^"\\]|\\.)*"|-?\d+(?:\.\d+)?(?=\s*[,}])|\{[^{}]*\})'
 )
 
 st.markdown("""
@@ -63,79 +127,358 @@ if "daily_goal" not in st.session_state:
         "fatG": 65
     }
 
-def image_to_base64(image: Image.Image) -> str:
-    buffer = BytesIO()
-    image.save(buffer, format="JPEG")
-    return base64.b64encode(buffer.getvalue()).decode()
+@st.cache_resource
+def get_response_cache():
+    # Shared across sessions and reruns; the lock guards TTLCache's internal expiry bookkeeping.
+    return TTLCache(maxsize=256, ttl=600), threading.Lock()
 
-def create_donut_chart(protein, carbs, fat):
-    source = pd.DataFrame({
-        "Category": ["Protein", "Carbs", "Fat"],
-        "Value": [protein, carbs, fat]
+@st.cache_resource
+def get_analysis_store():
+    # Survives browser sessions and server restarts, unlike the in-memory response cache.
+    conn = sqlite3.connect(ANALYSIS_DB_PATH, check_same_thread=False)
+    conn.execute("CREATE TABLE IF NOT EXISTS analyses (key TEXT PRIMARY KEY, data BLOB NOT NULL)")
+    conn.commit()
+    return conn, threading.Lock()
+
+def validate_analysis(analysis) -> dict:
+    # The results pane indexes these fields directly, so anything off-schema must never be cached.
+    def require(obj, name, fields):
+        if not isinstance(obj, dict):
+            raise ValueError(f"Malformed analysis: {name} is not an object")
+        for field, kind in fields.items():
+            value = obj.get(field)
+            if not isinstance(value, kind) or isinstance(value, bool):
+                raise ValueError(f"Malformed analysis: missing or invalid {field!r}")
+
+    number = (int, float)
+    require(analysis, "response", {
+        "foodName": str, "cuisineType": str, "calories": number, "insightSummary": str,
+        "macronutrients": dict, "recipe": dict, "allergenAlert": dict
     })
+    require(analysis["macronutrients"], "macronutrients", {"proteinG": number, "carbsG": number, "fatG": number})
+    require(analysis["recipe"], "recipe", {"title": str, "ingredients": list, "instructions": list})
+    require(analysis["allergenAlert"], "allergenAlert", {"riskLevel": str, "detected": list, "advice": str})
+    if analysis["allergenAlert"]["riskLevel"] not in RISK_LEVELS:
+        raise ValueError(f"Malformed analysis: unknown riskLevel {analysis['allergenAlert']['riskLevel']!r}")
+    if not isinstance(analysis.get("dietaryTags", []), list):
+        raise ValueError("Malformed analysis: invalid 'dietaryTags'")
+    return analysis
+
+def load_analysis(key: str):
+    conn, lock = get_analysis_store()
+    with lock:
+        row = conn.execute("SELECT data FROM analyses WHERE key = ?", (key,)).fetchone()
+    if not row:
+        return None
+    try:
+        return validate_analysis(orjson.loads(row[0]))
+    except ValueError:
+        # Rows written before validation existed are treated as a miss and replaced on the next save.
+        return None
+
+def save_analysis(key: str, analysis: dict):
+    conn, lock = get_analysis_store()
+    with lock:
+        conn.execute("INSERT OR REPLACE INTO analyses (key, data) VALUES (?, ?)", (key, orjson.dumps(analysis)))
+        conn.commit()
+
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    # Keep-alive pool so repeated analyses skip the TCP + TLS handshake.
+    session = requests.Session()
+    # Every Gemini request holds a request slot, so the pool never needs more connections than slots.
+    session.mount("https://", HTTPAdapter(pool_maxsize=MAX_IN_FLIGHT))
+    return session
+
+@st.cache_resource
+def get_request_slots() -> threading.BoundedSemaphore:
+    # Caps in-flight Gemini calls across all sessions.
+    return threading.BoundedSemaphore(MAX_IN_FLIGHT)
+
+def image_key(image_bytes: bytes) -> str:
+    # Hashes the bytes as uploaded, so cached analyses can be found before any encoding work.
+    return hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+
+def encode_image(image: Image.Image) -> bytes:
+    # Expects open_image output, which is already RGB and no larger than MAX_IMAGE_EDGE.
+    with BytesIO() as buffer:
+        image.save(buffer, format="JPEG", quality=82, optimize=True, progressive=True, subsampling=2)
+        return buffer.getvalue()
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def open_image(raw_bytes: bytes) -> Image.Image:
+    # Shrunk before caching: cache_data pickles the value on every hit, and a full-size
+    # 12 MP bitmap costs nearly as much to unpickle as the JPEG does to decode.
+    image = Image.open(BytesIO(raw_bytes))
+    # Lets libjpeg decode at a reduced scale directly; a no-op for other formats.
+    image.draft("RGB", (MAX_IMAGE_EDGE, MAX_IMAGE_EDGE))
+    image = image.convert("RGB")
+    image.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.LANCZOS)
+    return image
+
+@st.cache_data(show_spinner=False)
+def create_donut_chart(protein, carbs, fat):
+    # Deferred so cold starts and reruns without results never pay for importing altair.
+    import altair as alt
+
+    source = alt.Data(values=[
+        {"Category": category, "Value": value}
+        for category, value in zip(("Protein", "Carbs", "Fat"), (protein, carbs, fat))
+    ])
     
     base = alt.Chart(source).encode(
-        theta=alt.Theta("Value", stack=True)
+        theta=alt.Theta("Value:Q", stack=True)
     )
     
     pie = base.mark_arc(outerRadius=100, innerRadius=60).encode(
-        color=alt.Color("Category", scale=alt.Scale(domain=["Protein", "Carbs", "Fat"], range=["#36a2eb", "#ffcd56", "#ff6384"])),
-        order=alt.Order("Value", sort="descending"),
-        tooltip=["Category", "Value"]
+        color=alt.Color("Category:N", scale=alt.Scale(domain=["Protein", "Carbs", "Fat"], range=["#36a2eb", "#ffcd56", "#ff6384"])),
+        order=alt.Order("Value:Q", sort="descending"),
+        tooltip=["Category:N", "Value:Q"]
     )
     
     text = base.mark_text(radius=120).encode(
-        text="Value",
-        order=alt.Order("Value", sort="descending"),
+        text="Value:Q",
+        order=alt.Order("Value:Q", sort="descending"),
         color=alt.value("black")
     )
     
     return pie + text
 
-def call_gemini(image_b64: str):
-    system_prompt = """
-    You are NutriSnap AI, an expert food analyst.
-    Analyze the image of the meal and return a JSON object STRICTLY following this schema:
-    {
-      "foodName": "string",
-      "cuisineType": "string",
-      "calories": number,
-      "macronutrients": { "proteinG": number, "carbsG": number, "fatG": number },
-      "insightSummary": "string (short, engaging 1-sentence summary)",
-      "dietaryTags": ["string (e.g. Vegan, Keto, Gluten-Free, High-Protein)"],
-      "recipe": {
-        "title": "string",
-        "ingredients": ["string (with quantities)"],
-        "instructions": ["string"]
-      },
-      "allergenAlert": {
-        "riskLevel": "Low | Medium | High",
-        "detected": ["string"],
-        "advice": "string"
-      }
-    }
-    """
-    
+@st.cache_data(show_spinner=False)
+def format_tags(cuisine_type: str, dietary_tags: list[str]) -> str:
+    return " ".join(f"`{tag}`" for tag in [cuisine_type] + dietary_tags)
+
+def extract_partial_fields(text: str) -> dict:
+    fields = {}
+    for match in PARTIAL_FIELD_RE.finditer(text):
+        try:
+            fields[match.group(1)] = orjson.loads(match.group(2))
+        except orjson.JSONDecodeError:
+            pass
+    return fields
+
+def iter_sse_text(response: requests.Response):
+    for line in response.iter_lines():
+        if not line.startswith(b"data:"):
+            continue
+        event = orjson.loads(line[len(b"data:"):])
+        for candidate in event.get("candidates", []):
+            for part in candidate.get("content", {}).get("parts", []):
+                if "text" in part:
+                    yield part["text"]
+
+def render_partial(placeholder, fields: dict):
+    with placeholder.container():
+        if "foodName" in fields:
+            st.markdown(f"**{fields['foodName']}** `{fields.get('cuisineType', '...')}`")
+        if "calories" in fields:
+            st.metric("Energy", f"{fields['calories']} kcal")
+        if "macronutrients" in fields:
+            macros = fields["macronutrients"]
+            st.caption(f"Protein {macros.get('proteinG', '?')}g · Carbs {macros.get('carbsG', '?')}g · Fat {macros.get('fatG', '?')}g")
+
+def is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, requests.HTTPError):
+        return exc.response is not None and exc.response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout))
+
+@retry(
+    wait=wait_random_exponential(min=1, max=8),
+    stop=stop_after_attempt(4),
+    retry=retry_if_exception(is_retryable),
+    reraise=True
+)
+def post_gemini(method: str, payload: dict, stream: bool = False) -> requests.Response:
+    # Only the request itself is retried; once a streamed body is being read, failures propagate.
+    params = {"key": API_KEY, "alt": "sse"} if stream else {"key": API_KEY}
+    response = get_http_session().post(
+        f"{MODEL_URL}:{method}",
+        params=params,
+        data=orjson.dumps(payload),
+        headers={"Content-Type": "application/json"},
+        stream=stream,
+        timeout=60
+    )
+    if not response.ok:
+        response.close()
+    response.raise_for_status()
+    return response
+
+def image_part(jpeg_bytes: bytes) -> dict:
+    return {"inlineData": {"mimeType": "image/jpeg", "data": base64.b64encode(jpeg_bytes).decode("ascii")}}
+
+def stream_analysis(jpeg_bytes: bytes, on_partial=None) -> dict:
     payload = {
         "contents": [{
             "role": "user",
-            "parts": [
-                {"text": "Analyze this food photo and return structured nutrition data."},
-                {"inlineData": {"mimeType": "image/jpeg", "data": image_b64}}
-            ]
+            "parts": [ANALYZE_PROMPT_PART, image_part(jpeg_bytes)]
         }],
-        "systemInstruction": {"parts": [{"text": system_prompt}]},
-        "generationConfig": {"responseMimeType": "application/json"}
+        "systemInstruction": SYSTEM_INSTRUCTION,
+        "generationConfig": GENERATION_CONFIG
     }
 
-    response = requests.post(
-        f"{MODEL_URL}?key={API_KEY}",
-        headers={"Content-Type": "application/json"},
-        json=payload,
-        timeout=60
-    )
-    response.raise_for_status()
-    return json.loads(response.json()["candidates"][0]["content"]["parts"][0]["text"])
+    chunks = []
+    shown = {}
+    with get_request_slots():
+        with post_gemini("streamGenerateContent", payload, stream=True) as response:
+            for chunk in iter_sse_text(response):
+                chunks.append(chunk)
+                if on_partial is None:
+                    continue
+                fields = extract_partial_fields("".join(chunks))
+                if fields != shown:
+                    shown = fields
+                    on_partial(fields)
+    return orjson.loads("".join(chunks))
+
+def fetch_batch_analysis(images: list[bytes]) -> list:
+    # Returns one entry per image, in submission order; None marks an image whose analysis could not
+    # be matched to it by imageIndex (missing, duplicated or off-schema) and must be retried alone.
+    count = len(images)
+    parts = [{"text": f"Analyze these {count} food photos."}]
+    for index, jpeg_bytes in enumerate(images, 1):
+        parts += [{"text": f"Image {index}"}, image_part(jpeg_bytes)]
+    payload = {
+        "contents": [{"role": "user", "parts": parts}],
+        "systemInstruction": BATCH_SYSTEM_INSTRUCTION,
+        "generationConfig": GENERATION_CONFIG
+    }
+
+    with get_request_slots():
+        response = post_gemini("generateContent", payload)
+    envelope = orjson.loads(response.content)
+    results = orjson.loads(envelope["candidates"][0]["content"]["parts"][0]["text"])
+    if not isinstance(results, list) or len(results) != count:
+        raise ValueError(f"Expected {count} analyses from a batched request")
+
+    matched = {}
+    duplicates = set()
+    for item in results:
+        if not isinstance(item, dict):
+            continue
+        index = item.pop("imageIndex", None)
+        if isinstance(index, bool) or not isinstance(index, int) or not 1 <= index <= count:
+            continue
+        if index in matched:
+            duplicates.add(index)
+            continue
+        try:
+            matched[index] = validate_analysis(item)
+        except ValueError:
+            duplicates.add(index)
+    return [None if index in duplicates else matched.get(index) for index in range(1, count + 1)]
+
+class PendingAnalysis:
+    def __init__(self, jpeg_bytes: bytes):
+        self.jpeg_bytes = jpeg_bytes
+        self.future = Future()
+        # Partial field previews, only produced when the request ends up running alone.
+        self.updates = queue.Queue()
+
+# Coalesces analyses submitted within a short window into one Gemini call. A batch of one
+# is streamed as usual; larger batches go out as a single multi-image request and the
+# returned array is split back to each caller by imageIndex. Any image the batch could not
+# answer reliably is re-run on its own streaming request.
+class GeminiBatcher:
+    def __init__(self, max_batch_size: int, max_wait: float):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        threading.Thread(target=self._collect, name="nutrisnap-batcher", daemon=True).start()
+
+    def submit(self, jpeg_bytes: bytes) -> PendingAnalysis:
+        pending = PendingAnalysis(jpeg_bytes)
+        self._queue.put(pending)
+        return pending
+
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            # Nothing queued and nothing in flight means no concurrent traffic to coalesce with,
+            # so a lone request skips the batching window instead of paying max_wait for nothing.
+            with self._in_flight_lock:
+                idle = self._in_flight == 0
+            deadline = time.monotonic() + (0 if idle and self._queue.empty() else self.max_wait)
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            with self._in_flight_lock:
+                self._in_flight += len(batch)
+            for pending in batch:
+                pending.future.add_done_callback(self._finished)
+            threading.Thread(target=self._dispatch, args=(batch,), daemon=True).start()
+
+    def _finished(self, future: Future):
+        with self._in_flight_lock:
+            self._in_flight -= 1
+
+    def _dispatch(self, batch: list[PendingAnalysis]):
+        if len(batch) == 1:
+            self._run_single(batch[0])
+            return
+        try:
+            results = fetch_batch_analysis([pending.jpeg_bytes for pending in batch])
+        except Exception:
+            results = [None] * len(batch)
+        for pending, result in zip(batch, results):
+            if result is None:
+                threading.Thread(target=self._run_single, args=(pending,), daemon=True).start()
+            else:
+                pending.future.set_result(result)
+
+    def _run_single(self, pending: PendingAnalysis):
+        try:
+            result = stream_analysis(pending.jpeg_bytes, on_partial=pending.updates.put)
+        except Exception as e:
+            pending.future.set_exception(e)
+            return
+        pending.future.set_result(result)
+
+@st.cache_resource
+def get_batcher() -> GeminiBatcher:
+    return GeminiBatcher(BATCH_MAX_SIZE, BATCH_MAX_WAIT)
+
+def analyze_meal(image_bytes: bytes, image: Image.Image):
+    # Yields ("phase", message), ("partial", fields) and finally ("done", analysis) so the
+    # caller can repaint between stages instead of blocking until the full result is in.
+    key = image_key(image_bytes)
+    cache, lock = get_response_cache()
+    with lock:
+        cached = cache.get(key)
+    if cached is not None:
+        yield "phase", "Cache hit, reusing previous analysis."
+        yield "done", cached
+        return
+    stored = load_analysis(key)
+    if stored is not None:
+        yield "phase", "Found a saved analysis for this photo."
+        with lock:
+            cache[key] = stored
+        yield "done", stored
+        return
+
+    yield "phase", "Encoding image..."
+    jpeg_bytes = encode_image(image)
+
+    yield "phase", "Consulting AI Chef..."
+    pending = get_batcher().submit(jpeg_bytes)
+    while not pending.future.done():
+        try:
+            yield "partial", pending.updates.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    result = validate_analysis(pending.future.result())
+    save_analysis(key, result)
+    with lock:
+        cache[key] = result
+    yield "done", result
 
 with st.sidebar:
     st.header("⚙️ Profile & Goals")
@@ -161,12 +504,14 @@ with col1:
     input_method = st.radio("Input method", ["Camera", "Upload"], horizontal=True, label_visibility="collapsed")
     
     image = None
+    image_bytes = None
     if input_method == "Camera":
         camera_image = st.camera_input("Take a photo")
-        if camera_image: image = Image.open(camera_image)
+        if camera_image: image_bytes = camera_image.getvalue()
     else:
         uploaded_file = st.file_uploader("Upload image", type=["jpg", "jpeg", "png"])
-        if uploaded_file: image = Image.open(uploaded_file)
+        if uploaded_file: image_bytes = uploaded_file.getvalue()
+    if image_bytes: image = open_image(image_bytes)
 
     if image:
         st.image(image, caption="Ready for analysis", use_container_width=True, channels="RGB")
@@ -175,10 +520,17 @@ with col1:
         if st.button("⚡ Decode Nutrition"):
             with st.status("🔍 Analyzing food matrix...", expanded=True) as status:
                 try:
-                    st.write("Encoding image...")
-                    img_b64 = image_to_base64(image)
-                    st.write("Consulting AI Chef...")
-                    st.session_state.analysis = call_gemini(img_b64)
+                    preview = None
+                    for event, value in analyze_meal(image_bytes, image):
+                        if event == "phase":
+                            status.update(label=f"🔍 {value}")
+                            st.write(value)
+                        elif event == "partial":
+                            if preview is None:
+                                preview = st.empty()
+                            render_partial(preview, value)
+                        else:
+                            st.session_state.analysis = value
                     status.update(label="Analysis Complete!", state="complete", expanded=False)
                 except Exception as e:
                     status.update(label="Analysis Failed", state="error")
@@ -203,8 +555,7 @@ with col2:
         st.markdown(f"## {data['foodName']}")
         
        
-        tags = [data['cuisineType']] + data.get('dietaryTags', [])
-        st.markdown(" ".join([f"`{tag}`" for tag in tags]))
+        st.markdown(format_tags(data['cuisineType'], data.get('dietaryTags', [])))
         
         st.caption(f"📝 {data['insightSummary']}")
         
@@ -251,13 +602,11 @@ with col2:
             
             with col_ing:
                 st.markdown("**🛒 Ingredients**")
-                for ing in recipe["ingredients"]:
-                    st.markdown(f"- {ing}")
+                st.markdown("\n".join(f"- {ing}" for ing in recipe["ingredients"]))
             
             with col_inst:
                 st.markdown("**🍳 Instructions**")
-                for idx, step in enumerate(recipe["instructions"], 1):
-                    st.markdown(f"**{idx}.** {step}")
+                st.markdown("\n\n".join(f"**{idx}.** {step}" for idx, step in enumerate(recipe["instructions"], 1)))
 
        
         with tab3:
@@ -278,5 +627,4 @@ with col2:
                 
             if alert["detected"]:
                 st.write("Potential Allergens Detected:")
-                for item in alert["detected"]:
-                    st.markdown(f"- 🔴 **{item}**")
+                st.markdown("\n".join(f"- 🔴 **{item}**" for item in alert["detected"]))